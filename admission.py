@@ -0,0 +1,285 @@
+# Admission control: per-client rate limiting and a global concurrency
+# limit, shared by all worker processes on the host.
+#
+# AdmissionMiddleware wraps the WSGI app. Each client gets a token bucket
+# (`rate` requests per second, bursts of up to `burst`); an empty bucket
+# is answered with 429. On top of that at most `max_concurrency`
+# requests are handled at once across all workers; beyond that the
+# answer is 503. Both carry a Retry-After header and are produced
+# without touching the app.
+#
+# The state lives in one memory-mapped file:
+#
+#   header                  signature (layout and boot id)
+#   worker slots            (pid, requests in flight) per worker process
+#   buckets                 (tokens, last update) per client hash
+#
+# A worker only ever writes its own slot, so counting requests in flight
+# takes no locks (in the single-threaded gevent workers); the total is
+# the sum of all slots. There are `slots` of them, by default four per
+# worker (WEB_CONCURRENCY, which server.py sets): during a reload two
+# generations of workers hold one each. A worker clears its slot when it
+# exits; a worker that can't do that (it was killed) has its slot
+# cleared by the next worker to start, or when the limit is hit. A worker
+# that finds no free slot fails when the app is created, not on every
+# request.
+#
+# A file of another layout is replaced rather than resized, since the
+# workers of the previous generation may still have it mapped. Buckets are shared, and updated under an fcntl
+# lock on just that bucket's bytes. Clients are hashed onto a fixed
+# number of buckets; two clients sharing a bucket share its limit.
+#
+# A client is identified by the X-Forwarded-For entry that the outermost
+# of `proxy_hops` proxies appended, or by the peer address if there are
+# none. Too few hops and every client looks like the proxy in front of
+# the app and they all share one bucket. The header is only trustworthy
+# if clients can't reach server.py directly: its default --bind 0.0.0.0
+# lets them send their own X-Forwarded-For and pick their bucket, so
+# behind a proxy bind to 127.0.0.1 (as the Procfile does).
+import atexit
+import fcntl
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from metrics import pid_alive
+
+_header = struct.Struct('<Q')
+_slot = struct.Struct('<qq')
+_bucket = struct.Struct('<dd')
+
+# how often, at most, a worker at the concurrency limit checks for the
+# slots of dead workers.
+SWEEP_INTERVAL = 1.0
+
+
+def default_path():
+    return os.environ.get('ADMISSION_FILE', os.path.join(
+        tempfile.gettempdir(), 'flasktest-admission.bin'))
+
+
+# bucket stamps are monotonic times and slots hold pids; both only mean
+# something until the host reboots, and the file may survive that.
+def _boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def default_slots():
+    workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+    return max(32, 4 * workers)
+
+
+class AdmissionMiddleware(object):
+
+    def __init__(self, app, rate, burst, max_concurrency=0, buckets=65536,
+                 proxy_hops=1, path=None, slots=None):
+        self.app = app
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_concurrency = max_concurrency
+        self.buckets = buckets
+        self.proxy_hops = proxy_hops
+        self.path = path or default_path()
+        self.slots = slots or default_slots()
+        self.signature = zlib.crc32(repr((self.slots, buckets,
+                                          _boot_id())).encode())
+        self.slots_offset = _header.size
+        self.buckets_offset = self.slots_offset + self.slots * _slot.size
+        self.size = self.buckets_offset + buckets * _bucket.size
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.close)
+        # claims a slot now, so running out of them fails the worker's
+        # start. A forked child claims its own on its first request.
+        self._open()
+
+    # a forked child has to map the file itself and claim its own slot.
+    def _reset(self):
+        self.fd = None
+        self.map = None
+        self.inflight = None
+        self.slot = None
+        self.swept = 0.0
+
+    # the file, open and locked. Waiting for the lock, the file may have
+    # been replaced; then the new one is locked instead.
+    def _lock_file(self):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    # a fresh, locked file in place of the one at `path`.
+    def _replace(self):
+        temporary = '%s.%d' % (self.path, os.getpid())
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        os.ftruncate(fd, self.size)
+        os.pwrite(fd, _header.pack(self.signature), 0)
+        os.replace(temporary, self.path)
+        return fd
+
+    def _open(self):
+        fd = self._lock_file()
+        try:
+            # a file with another layout is from an older deploy, one with
+            # another boot id from before a reboot.
+            header = os.pread(fd, _header.size, 0)
+            if len(header) < _header.size or \
+                    _header.unpack(header)[0] != self.signature or \
+                    os.fstat(fd).st_size != self.size:
+                old, fd = fd, self._replace()
+                os.close(old)
+            mm = mmap.mmap(fd, self.size)
+            slots = memoryview(mm)[self.slots_offset:self.buckets_offset] \
+                .cast('q')
+            # take a free slot, and reset the slots of dead workers on the
+            # way so their requests in flight stop counting.
+            self._sweep(slots)
+            pids = slots[0::2].tolist()
+            if 0 not in pids:
+                raise RuntimeError('more than %d workers share %s; the '
+                                   'slots are sized from WEB_CONCURRENCY' %
+                                   (self.slots, self.path))
+            mine = pids.index(0)
+            slots[2 * mine] = os.getpid()
+            slots[2 * mine + 1] = 0
+        except BaseException:
+            os.close(fd)
+            raise
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        self.fd, self.map, self.inflight = fd, mm, slots
+        self.slot = 2 * mine + 1
+
+    # clears the slots of dead workers; the caller holds the file lock.
+    def _sweep(self, slots):
+        for i in range(0, len(slots), 2):
+            pid = slots[i]
+            if pid and not pid_alive(pid):
+                slots[i] = slots[i + 1] = 0
+
+    # frees this worker's slot; registered with atexit.
+    def close(self):
+        if self.map is None:
+            return
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if self.inflight[self.slot - 1] == os.getpid():
+                self.inflight[self.slot - 1] = self.inflight[self.slot] = 0
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    # requests in flight across the host. At the limit, the slots of
+    # workers that died without clearing theirs are cleared, at most
+    # once every SWEEP_INTERVAL.
+    def busy(self):
+        inflight = self.inflight
+        total = sum(inflight[1::2])
+        if total < self.max_concurrency:
+            return False
+        now = time.monotonic()
+        if now - self.swept < SWEEP_INTERVAL:
+            return True
+        self.swept = now
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            self._sweep(inflight)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        return sum(inflight[1::2]) >= self.max_concurrency
+
+    def client(self, environ):
+        if self.proxy_hops:
+            forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+            if forwarded:
+                hops = forwarded.split(',')
+                return hops[max(len(hops) - self.proxy_hops, 0)].strip()
+        return environ.get('REMOTE_ADDR', '')
+
+    # takes a token from the client's bucket. Returns 0 when the request
+    # may go ahead, otherwise the seconds until a token is available.
+    def take(self, client):
+        index = zlib.crc32(client.encode('utf-8', 'replace')) % self.buckets
+        offset = self.buckets_offset + index * _bucket.size
+        now = time.monotonic()
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, _bucket.size, offset)
+            try:
+                tokens, stamp = _bucket.unpack_from(self.map, offset)
+                if stamp:
+                    # never negative, even if the stamp isn't from this
+                    # boot after all.
+                    tokens = min(self.burst, tokens + max(0.0, now - stamp) *
+                                 self.rate)
+                else:
+                    tokens = self.burst
+                if tokens >= 1:
+                    _bucket.pack_into(self.map, offset, tokens - 1, now)
+                    return 0
+                _bucket.pack_into(self.map, offset, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, _bucket.size, offset)
+        return (1 - tokens) / self.rate
+
+    def __call__(self, environ, start_response):
+        if self.map is None:
+            self._open()
+        if self.rate:
+            wait = self.take(self.client(environ))
+            if wait:
+                return _reject(start_response, '429 Too Many Requests',
+                               wait)
+        if self.max_concurrency and self.busy():
+            return _reject(start_response, '503 Service Unavailable', 1)
+        inflight = self.inflight
+        slot = self.slot
+        inflight[slot] += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            inflight[slot] -= 1
+            raise
+        return _Release(body, inflight, slot)
+
+
+def _reject(start_response, status, wait):
+    body = status[4:].encode('ascii') + b'\n'
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                            ('Content-Length', str(len(body))),
+                            ('Retry-After', str(max(1, math.ceil(wait))))])
+    return [body]
+
+
+# response iterable that ends the request's turn in flight on close.
+class _Release(object):
+    __slots__ = ('body', 'inflight', 'slot')
+
+    def __init__(self, body, inflight, slot):
+        self.body = body
+        self.inflight = inflight
+        self.slot = slot
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.inflight[self.slot] -= 1
@@ -28,7 +28,17 @@ if __name__ == '__main__':
     application.run()
 
 """
-from flask import Flask
+import atexit
+import os
+
+from flask import Flask, jsonify
+
+from admission import AdmissionMiddleware
+from lazy import lazy_view
+from live import Hub, LiveMiddleware
+from metrics import MetricsMiddleware
+from response_cache import CachedPage, PageCache
+from visits import VisitCounter
 
 # print a nice greeting.
 def say_hello(username = "World"):
@@ -44,17 +54,113 @@ instructions = '''
 home_link = '<p><a href="/">Back</a></p>\n'
 footer_text = '</body>\n</html>'
 
-# EB looks for an 'application' callable by default.
-application = Flask(__name__)
+# build the app. `config` overrides the defaults below, which can also
+# be set through the environment. Features other than the two pages are
+# registered with lazy_view, so their modules (and whatever those
+# import) only load when first requested.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(
+        HELLO_CACHE_SIZE=int(os.environ.get('HELLO_CACHE_SIZE', 1024)),
+        BATCH_MAX_ITEMS=int(os.environ.get('BATCH_MAX_ITEMS', 10000)),
+        METRICS_DIR=os.environ.get('METRICS_DIR'),
+        SQLALCHEMY_DATABASE_URI=os.environ.get('SQLALCHEMY_DATABASE_URI',
+            'sqlite:///visits.db'),
+        VISITS_FLUSH_INTERVAL=float(os.environ.get('VISITS_FLUSH_INTERVAL',
+            5.0)),
+        VISITS_FLUSH_SIZE=int(os.environ.get('VISITS_FLUSH_SIZE', 10000)),
+        VISITS_SNAPSHOT_TTL=float(os.environ.get('VISITS_SNAPSHOT_TTL',
+            5.0)),
+        # the per-client limit is off by default; turn it on once
+        # ADMISSION_PROXY_HOPS matches the deployment (see admission.py).
+        ADMISSION_RATE=float(os.environ.get('ADMISSION_RATE', 0)),
+        ADMISSION_BURST=float(os.environ.get('ADMISSION_BURST', 100)),
+        ADMISSION_MAX_CONCURRENCY=int(os.environ.get(
+            'ADMISSION_MAX_CONCURRENCY', 1000)),
+        # proxies in front of us that append to X-Forwarded-For: 1 for
+        # nginx alone, 2 behind EB's load balancer and nginx.
+        ADMISSION_PROXY_HOPS=int(os.environ.get('ADMISSION_PROXY_HOPS', 1)),
+        ADMISSION_FILE=os.environ.get('ADMISSION_FILE'),
+        LIVE_DIR=os.environ.get('LIVE_DIR'),
+        LIVE_PING_INTERVAL=float(os.environ.get('LIVE_PING_INTERVAL', 30.0)),
+    )
+    if config:
+        app.config.update(config)
+
+    # the pages are precompiled (see response_cache.py): the index page
+    # is built once, greeting pages are kept in a bounded LRU cache.
+    index_page = CachedPage(header_text + say_hello() + instructions +
+        footer_text)
+    hello_pages = PageCache(maxsize=app.config['HELLO_CACHE_SIZE'])
+
+    # add a rule for the index page.
+    app.add_url_rule('/', 'index', index_page.respond)
+
+    # greetings are counted in memory and written to the database in
+    # batches (see visits.py).
+    visits = VisitCounter(app.config['SQLALCHEMY_DATABASE_URI'],
+        flush_interval=app.config['VISITS_FLUSH_INTERVAL'],
+        flush_size=app.config['VISITS_FLUSH_SIZE'],
+        snapshot_ttl=app.config['VISITS_SNAPSHOT_TTL'])
+    atexit.register(visits.close)
+    app.extensions['visits'] = visits
+
+    # pushes greetings to WebSocket subscribers on /live (see live.py).
+    hub = Hub(lambda username: {'greeting': say_hello(username),
+        'visits': visits.count(username)}, directory=app.config['LIVE_DIR'],
+        ping_interval=app.config['LIVE_PING_INTERVAL'])
+    app.extensions['live'] = hub
 
-# add a rule for the index page.
-application.add_url_rule('/', 'index', (lambda: header_text +
-    say_hello() + instructions + footer_text))
+    # add a rule when the page is accessed with a name appended to the
+    # site URL.
+    def hello(username):
+        visits.record(username)
+        hub.publish(username)
+        return hello_pages.get(username, lambda: header_text +
+            say_hello(username) + home_link + footer_text).respond()
+    app.add_url_rule('/<username>', 'hello', hello)
 
-# add a rule when the page is accessed with a name appended to the site
-# URL.
-application.add_url_rule('/<username>', 'hello', (lambda username:
-    header_text + say_hello(username) + home_link + footer_text))
+    # add a rule for how often someone has been greeted.
+    app.add_url_rule('/stats/<username>', 'stats', (lambda username:
+        jsonify(username=username, visits=visits.count(username))))
+
+    # add a rule for downloading the visit counts as CSV or XLSX. This
+    # takes over the greeting page of a user called "export".
+    app.add_url_rule('/export', 'export', lazy_view('export', 'export_view',
+        visits))
+
+    # add a rule for greeting many users in one request. Only POST is
+    # bound, so a GET for /batch still greets a user called "batch".
+    app.add_url_rule('/batch', 'batch', lazy_view('batch', 'batch_view',
+        say_hello, app.config['BATCH_MAX_ITEMS']), methods=['POST'])
+
+    # turn clients away early when they send too much, or when the host
+    # is busy (see admission.py). ADMISSION_RATE=0 turns off the per-client
+    # limit, ADMISSION_MAX_CONCURRENCY=0 the global one.
+    if app.config['ADMISSION_RATE'] or app.config['ADMISSION_MAX_CONCURRENCY']:
+        app.wsgi_app = AdmissionMiddleware(app.wsgi_app,
+            rate=app.config['ADMISSION_RATE'],
+            burst=app.config['ADMISSION_BURST'],
+            max_concurrency=app.config['ADMISSION_MAX_CONCURRENCY'],
+            proxy_hops=app.config['ADMISSION_PROXY_HOPS'],
+            path=app.config['ADMISSION_FILE'])
+
+    # count requests per endpoint and serve them on /metrics. This goes
+    # last so that it knows every endpoint and sees rejected requests
+    # too; /metrics itself is never rate limited. It takes over the
+    # greeting page of a user called "metrics".
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, app.view_functions,
+        app.config['METRICS_DIR'])
+
+    # WebSocket connections on /live are long-lived, so they bypass both
+    # the admission limits and the latency metrics. This takes over the
+    # greeting page of a user called "live".
+    app.wsgi_app = LiveMiddleware(app.wsgi_app, hub)
+
+    return app
+
+# EB looks for an 'application' callable by default.
+application = create_app()
 
 # run the app.
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+# Batch greetings: POST a list of usernames to /batch and get one NDJSON
+# line per username back.
+#
+# The request body is either a JSON array of strings
+# (Content-Type: application/json), NDJSON with one JSON string per line
+# (application/x-ndjson) or plain text with one username per line
+# (anything else). The body is parsed incrementally while the response
+# is being written, so neither side is ever held in memory as a whole.
+#
+# Once streaming has started the status can't change anymore, so errors
+# (bad input, too many items) end the stream with an {"error": ...} line.
+import codecs
+import json
+
+from flask import Response, request, stream_with_context
+
+READ_SIZE = 16 * 1024
+# responses are written in chunks of about this size rather than one
+# chunk per greeting.
+WRITE_SIZE = 16 * 1024
+MAX_USERNAME = 1024
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _lines(stream):
+    while True:
+        line = stream.readline(MAX_USERNAME + 2)
+        if not line:
+            return
+        if not line.endswith(b'\n') and len(line) > MAX_USERNAME:
+            raise BatchError('username longer than %d bytes' % MAX_USERNAME)
+        line = line.strip()
+        if line:
+            yield line
+
+
+def iter_text(stream):
+    for line in _lines(stream):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise BatchError('invalid UTF-8 in username')
+
+
+def iter_ndjson(stream):
+    for line in _lines(stream):
+        try:
+            username = json.loads(line)
+        except ValueError:
+            raise BatchError('invalid JSON line')
+        if not isinstance(username, str):
+            raise BatchError('usernames must be strings')
+        yield username
+
+
+# incremental parser for a JSON array of strings. Only the unparsed tail
+# of the input is buffered.
+def iter_json_array(stream):
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    buf, pos, eof = '', 0, False
+
+    # drops what has been parsed and appends the next chunk.
+    def refill():
+        nonlocal buf, pos, eof
+        if eof:
+            raise BatchError('invalid or truncated JSON array')
+        if len(buf) - pos > MAX_USERNAME * 6 + 2:
+            raise BatchError('username longer than %d bytes' % MAX_USERNAME)
+        chunk = stream.read(READ_SIZE)
+        eof = not chunk
+        try:
+            buf = buf[pos:] + decode(chunk, final=eof)
+        except UnicodeDecodeError:
+            raise BatchError('invalid UTF-8 in request body')
+        pos = 0
+
+    expect = '['
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos == len(buf):
+            refill()
+            continue
+        c = buf[pos]
+        if expect == '[':
+            if c != '[':
+                raise BatchError('expected a JSON array')
+            pos += 1
+            expect = 'first'
+        elif c == ']' and expect != 'item':
+            return
+        elif expect == 'separator':
+            if c != ',':
+                raise BatchError("expected ',' or ']'")
+            pos += 1
+            expect = 'item'
+        elif c != '"':
+            raise BatchError('usernames must be strings')
+        else:
+            try:
+                username, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the string isn't complete yet.
+                refill()
+                continue
+            pos = end
+            expect = 'separator'
+            yield username
+
+
+def _usernames(stream, mimetype):
+    if mimetype == 'application/json':
+        return iter_json_array(stream)
+    if mimetype == 'application/x-ndjson':
+        return iter_ndjson(stream)
+    return iter_text(stream)
+
+
+def _error(message):
+    return json.dumps({'error': message}).encode('utf-8') + b'\n'
+
+
+# returns the view for the batch rule. `greet` builds one greeting.
+def batch_view(greet, max_items):
+
+    def generate(usernames):
+        out, size, count = [], 0, 0
+        try:
+            for username in usernames:
+                count += 1
+                if count > max_items:
+                    out.append(_error('batch is limited to %d usernames' %
+                                      max_items))
+                    break
+                line = json.dumps({'username': username,
+                                   'greeting': greet(username)})
+                line = line.encode('utf-8') + b'\n'
+                out.append(line)
+                size += len(line)
+                if size >= WRITE_SIZE:
+                    yield b''.join(out)
+                    out, size = [], 0
+        except BatchError as e:
+            out.append(_error(str(e)))
+        if out:
+            yield b''.join(out)
+
+    def view():
+        usernames = _usernames(request.stream, request.mimetype)
+        return Response(stream_with_context(generate(usernames)),
+                        mimetype='application/x-ndjson')
+
+    return view
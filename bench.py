@@ -0,0 +1,280 @@
+# Throughput and latency benchmark for the WSGI application.
+#
+#   python bench.py inprocess                 # through the Werkzeug test client
+#   python bench.py server --concurrency 32   # against server.py over HTTP
+#
+# Reports requests/sec and p50/p95/p99 latency per route; the in-process
+# mode also reports the peak memory allocated per request (tracemalloc).
+# Results are printed and written to bench_output.txt.
+#
+# --save-baseline stores the results in bench_baseline.json; later runs
+# are compared against it and exit with status 1 when a route got slower,
+# or allocates more per request, than --threshold allows.
+#
+# The app's state (metrics, admission table, visits database) goes to a
+# temporary directory, so a benchmark never touches a serving instance's.
+import argparse
+import http.client
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROUTES = {
+    'index': lambda n: '/',
+    'hello': lambda n: '/bench',
+    # a different user every time, so the page cache always misses.
+    'hello-miss': lambda n: '/bench%d' % n,
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 *
+                                             (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+# points the app's files at `directory`; server mode passes these on to
+# server.py through the environment.
+def isolate(directory):
+    os.environ['METRICS_DIR'] = os.path.join(directory, 'metrics')
+    os.environ['ADMISSION_FILE'] = os.path.join(directory, 'admission.bin')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+        directory, 'visits.db')
+
+
+def bench_inprocess(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # every request comes from the same client; see bench_server.
+    os.environ.setdefault('ADMISSION_RATE', '0')
+    from application import application
+    client = application.test_client()
+
+    # responses have to be closed, like a server would, or the admission
+    # middleware keeps counting them as in flight.
+    def get(url):
+        response = client.get(url)
+        response.close()
+        return response.status_code
+
+    results = {}
+    for name, path in ROUTES.items():
+        counter = itertools.count()
+        for _ in range(args.warmup):
+            get(path(next(counter)))
+        latencies = []
+        errors = 0
+        clock = time.perf_counter
+        start = clock()
+        for _ in range(args.requests):
+            url = path(next(counter))
+            t = clock()
+            status = get(url)
+            latencies.append(clock() - t)
+            if status != 200:
+                errors += 1
+        result = summarize(latencies, clock() - start)
+        result['errors'] = errors
+
+        # a separate pass, tracing slows everything down.
+        samples = min(args.requests, 1000)
+        tracemalloc.start()
+        total = 0
+        for _ in range(samples):
+            url = path(next(counter))
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            get(url)
+            total += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        result['alloc_bytes'] = total / samples
+        results['inprocess:' + name] = result
+    # write the visits out while the database is still there.
+    application.extensions['visits'].close()
+    return results
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start on port %d' % port)
+
+
+# one keep-alive connection per thread, each sending requests until the
+# shared budget is used up.
+def _load(port, path, requests, concurrency):
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        clock = time.perf_counter
+        try:
+            while True:
+                n = next(counter)
+                if n >= requests:
+                    break
+                t = clock()
+                conn.request('GET', path(n))
+                response = conn.getresponse()
+                response.read()
+                local.append(clock() - t)
+                if response.status != 200:
+                    errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(e)
+        finally:
+            conn.close()
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, time.perf_counter() - start)
+    result['errors'] = len(errors)
+    return result
+
+
+def bench_server(args):
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    # all load comes from one address, so the per-client limit would turn
+    # most of it away unless it's set explicitly.
+    env = dict(os.environ)
+    env.setdefault('ADMISSION_RATE', '0')
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'server.py'),
+                               '--bind', '127.0.0.1:%d' % port,
+                               '--workers', str(args.workers)], cwd=here,
+                              env=env)
+    try:
+        _wait_for(port)
+        results = {}
+        for name, path in ROUTES.items():
+            _load(port, path, args.warmup, args.concurrency)
+            results['server:' + name] = _load(port, path, args.requests,
+                                              args.concurrency)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# returns the list of regressions beyond threshold (a fraction).
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append('%s: %.0f req/s, baseline %.0f' %
+                               (key, result['rps'], base['rps']))
+        if result['p99_ms'] > base['p99_ms'] * (1 + threshold):
+            regressions.append('%s: p99 %.3f ms, baseline %.3f ms' %
+                               (key, result['p99_ms'], base['p99_ms']))
+        if 'alloc_bytes' in result and 'alloc_bytes' in base and \
+                result['alloc_bytes'] > base['alloc_bytes'] * (1 + threshold):
+            regressions.append('%s: %.0f B/req allocated, baseline %.0f' %
+                               (key, result['alloc_bytes'],
+                                base['alloc_bytes']))
+    return regressions
+
+
+def format_results(results):
+    lines = ['%-22s %10s %9s %9s %9s %12s %7s' % ('route', 'req/s',
+                                                  'p50 ms', 'p95 ms',
+                                                  'p99 ms', 'alloc B/req',
+                                                  'errors')]
+    for key, r in sorted(results.items()):
+        alloc = '%.0f' % r['alloc_bytes'] if 'alloc_bytes' in r else '-'
+        lines.append('%-22s %10.0f %9.3f %9.3f %9.3f %12s %7d' % (
+            key, r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], alloc,
+            r.get('errors', 0)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the application.')
+    parser.add_argument('mode', choices=['inprocess', 'server'])
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='client connections (server mode)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server.py worker processes (server mode)')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown against the baseline')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='bench-') as state:
+        isolate(state)
+        if args.mode == 'inprocess':
+            results = bench_inprocess(args)
+        else:
+            results = bench_server(args)
+    report = format_results(results)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        report += '\n\nbaseline saved to %s' % args.baseline
+    elif baseline:
+        regressions = compare(results, baseline, args.threshold)
+        report += '\n\n' + ('\n'.join(['REGRESSION ' + r for r in
+                                       regressions]) or
+                            'no regressions against %s' % args.baseline)
+
+    print(report)
+    with open(args.output, 'w') as f:
+        f.write(report + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
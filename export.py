@@ -0,0 +1,126 @@
+# Greeting statistics as a spreadsheet: GET /export?format=csv (default)
+# or /export?format=xlsx.
+#
+# Counts are read from the database in chunks of CHUNK_ROWS; each chunk
+# becomes a DataFrame whose derived columns are computed with vectorized
+# operations. CSV chunks go to the client as soon as they're built. An
+# XLSX file is a zip archive that can only be finished once every row is
+# written, so it's built with XlsxWriter's constant_memory mode (one row
+# in memory at a time) into a temporary file, which is then streamed.
+# XlsxWriter needs some 40 microseconds a row, so in the gevent workers
+# the rows are written on the thread pool (see visits.run_blocking)
+# instead of stalling every other request; the response headers are sent
+# before the build starts.
+#
+# A spreadsheet opening the CSV would evaluate a cell that starts with
+# one of FORMULA_PREFIXES, and usernames come from anyone's URL, so such
+# cells get a leading quote. XLSX cells are written as strings and are
+# never evaluated.
+#
+# Between chunks the generator sleeps for 0 seconds; in the gevent
+# workers that lets other requests run while a big report is built.
+import tempfile
+import time
+
+from flask import Response, abort, request, stream_with_context
+
+from lazy import lazy_import
+from visits import run_blocking
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+CHUNK_ROWS = 50000
+READ_SIZE = 64 * 1024
+# XLSX worksheets hold at most 1048576 rows, one of them is the header.
+SHEET_ROWS = 1048575
+COLUMNS = ['username', 'visits', 'share']
+FORMULA_PREFIXES = ['=', '+', '-', '@', '\t', '\r']
+
+
+def _frames(total, chunks):
+    for rows in chunks:
+        frame = pd.DataFrame.from_records(rows, columns=COLUMNS[:2])
+        visits = frame['visits'].to_numpy(dtype=np.int64)
+        frame['share'] = visits / total if total else np.zeros(len(visits))
+        yield frame
+        time.sleep(0)
+
+
+def iter_csv(total, chunks):
+    header = True
+    for frame in _frames(total, chunks):
+        usernames = frame['username']
+        formulas = usernames.str[:1].isin(FORMULA_PREFIXES)
+        if formulas.any():
+            frame.loc[formulas, 'username'] = "'" + usernames[formulas]
+        yield frame.to_csv(index=False, header=header).encode('utf-8')
+        header = False
+    if header:
+        yield (','.join(COLUMNS) + '\n').encode('utf-8')
+
+
+def iter_xlsx(total, chunks):
+    xlsxwriter = lazy_import('xlsxwriter')
+    # an empty chunk makes server.py send the headers right away.
+    yield b''
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        percent = workbook.add_format({'num_format': '0.00%'})
+        sheet, row = None, SHEET_ROWS
+
+        def write(frame):
+            nonlocal sheet, row
+            for username, visits, share in zip(
+                    frame['username'].tolist(), frame['visits'].tolist(),
+                    frame['share'].tolist()):
+                if row == SHEET_ROWS:
+                    sheet = workbook.add_worksheet()
+                    sheet.write_row(0, 0, COLUMNS)
+                    row = 0
+                row += 1
+                sheet.write_string(row, 0, username)
+                sheet.write_number(row, 1, visits)
+                sheet.write_number(row, 2, share, percent)
+
+        def finish():
+            if sheet is None:
+                workbook.add_worksheet().write_row(0, 0, COLUMNS)
+            workbook.close()
+            output.seek(0)
+
+        for frame in _frames(total, chunks):
+            run_blocking(write, frame)
+        run_blocking(finish)
+        while True:
+            data = output.read(READ_SIZE)
+            if not data:
+                break
+            yield data
+            time.sleep(0)
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (iter_xlsx, 'application/vnd.openxmlformats-officedocument.'
+                        'spreadsheetml.sheet'),
+}
+
+
+# returns the view for the export rule, reading from a VisitCounter.
+def export_view(visits):
+
+    def view():
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            abort(400, 'format must be one of: %s' % ', '.join(FORMATS))
+        generate, mimetype = FORMATS[fmt]
+        # include what this worker hasn't written yet.
+        visits.flush()
+        total, chunks = visits.stored_counts(CHUNK_ROWS)
+        return Response(stream_with_context(generate(total, chunks)),
+                        mimetype=mimetype, headers={
+                            'Content-Disposition':
+                                'attachment; filename=greetings.%s' % fmt})
+
+    return view
@@ -0,0 +1,47 @@
+# Deferred imports, to keep worker start-up cheap.
+#
+# Most of the heavy packages in requirements.txt (pandas, numpy,
+# SQLAlchemy, ...) are only needed by a few features. Going through
+# these helpers means a worker pays for them the first time a feature
+# is actually used instead of at boot.
+import importlib
+import importlib.util
+import sys
+import threading
+
+
+# returns the module, loading it on first attribute access. Importing
+# a missing module still fails right here, not on first use.
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %r' % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# a view that imports `module` and builds the real view with
+# `factory(*args, **kwargs)` on its first request.
+def lazy_view(module, factory, *args, **kwargs):
+    lock = threading.Lock()
+    view = None
+
+    def resolve():
+        nonlocal view
+        with lock:
+            if view is None:
+                view = getattr(importlib.import_module(module), factory)(
+                    *args, **kwargs)
+        return view
+
+    def dispatch(**values):
+        return (view or resolve())(**values)
+
+    return dispatch
@@ -0,0 +1,393 @@
+# Live greetings over WebSocket, at /live.
+#
+# A client subscribes to usernames by sending
+#
+#   {"subscribe": ["Thelonious", ...]}      (or "unsubscribe")
+#
+# and gets one {"event": "subscribed", ...} message per name, with the
+# greeting and the current visit count, then a {"event": "visit", ...}
+# message with the same fields when that name is greeted. The count is
+# read by the subscriber's own worker (see visits.py), so it can trail
+# by the visits other workers haven't flushed yet, and by the snapshot
+# TTL.
+#
+# Every message is serialized and framed once and the same bytes are
+# queued for all subscribers. Idle connections cost only their handler
+# greenlet; a writer greenlet exists only while a connection has queued
+# messages. A subscriber that falls `max_queue` messages behind is
+# disconnected rather than buffered for; so is one whose socket fails.
+# Every `ping_interval` seconds each connection gets a ping frame, so
+# proxies with an idle timeout (60 seconds for nginx and the EB load
+# balancer) don't drop quiet subscribers.
+#
+# A greeting is served by one worker, but its subscribers may be
+# connected to any of them. While a worker has WebSocket connections it
+# listens on a Unix datagram socket, live-<pid>.sock in `directory`, and
+# advertises what its connections subscribe to in live-<pid>.subs: a
+# memory-mapped table of subscription counts per username hash, written
+# only by that worker. The worker that greets someone looks the name up
+# in every table and sends just the username to the workers that want
+# it. A worker that gets a username, or greets one its own connections
+# subscribe to, builds the message (which reads the visit count) in a
+# greenlet of its own, so greetings never wait for the database. More
+# greetings of a name whose message is still being built don't start
+# another one.
+#
+# Sends never block: a worker too far behind to take a datagram misses
+# that greeting. Names that share a hash with a subscribed one cost a
+# datagram that is dropped on arrival. The directory has to belong to
+# this user and be closed to everyone else; otherwise no greetings are
+# sent there and /live refuses connections.
+#
+# WebSockets need server.py (gevent-websocket).
+import collections
+import json
+import mmap
+import os
+import socket
+import tempfile
+import time
+import zlib
+
+from lazy import lazy_import
+
+gevent = lazy_import('gevent')
+
+OPCODE_TEXT = 0x1
+OPCODE_PING = 0x9
+
+# a datagram is a username in UTF-8.
+MAX_DATAGRAM = 65536
+# entries in a worker's table of subscriptions.
+SUBSCRIPTION_BUCKETS = 65536
+
+
+def default_directory():
+    return os.environ.get('LIVE_DIR', os.path.join(
+        tempfile.gettempdir(), 'flasktest-live'))
+
+
+# the complete WebSocket text frame for a message.
+def _frame(fields):
+    from geventwebsocket.websocket import Header
+
+    payload = json.dumps(fields).encode('utf-8')
+    return Header.encode_header(True, OPCODE_TEXT, b'', len(payload),
+                                0) + payload
+
+
+def _bucket(username):
+    return zlib.crc32(username.encode('utf-8', 'surrogatepass')) % \
+        SUBSCRIPTION_BUCKETS
+
+
+def _ping():
+    from geventwebsocket.websocket import Header
+
+    return Header.encode_header(True, OPCODE_PING, b'', 0, 0)
+
+
+class Subscriber(object):
+    __slots__ = ('hub', 'ws', 'queue', 'writer', 'usernames')
+
+    def __init__(self, hub, ws):
+        self.hub = hub
+        self.ws = ws
+        self.queue = collections.deque()
+        self.writer = None
+        self.usernames = set()
+
+    def push(self, frame):
+        if len(self.queue) >= self.hub.max_queue:
+            self.hub.evict(self)
+            return
+        self.queue.append(frame)
+        if self.writer is None:
+            self.writer = gevent.spawn(self._drain)
+
+    def _drain(self):
+        queue = self.queue
+        try:
+            while queue and self.ws is not None:
+                self.ws.raw_write(queue.popleft())
+        except Exception:
+            self.hub.evict(self)
+        finally:
+            self.writer = None
+
+
+class Hub(object):
+
+    # `snapshot(username)` returns the fields of the "subscribed" and
+    # "visit" messages.
+    def __init__(self, snapshot, directory=None, ping_interval=30.0,
+                 max_queue=64, max_subscriptions=100):
+        self.snapshot = snapshot
+        self.directory = directory or default_directory()
+        self.ping_interval = ping_interval
+        self.max_queue = max_queue
+        self.max_subscriptions = max_subscriptions
+        self.subscribers = {}
+        self.connections = set()
+        # this worker's socket and subscription table, while it listens.
+        self.sock = None
+        self.path = None
+        self.counts = None
+        # (socket path, subscription table) of every listening worker.
+        self.peers = []
+        self._sender = None
+        self._listing = None
+        self._listeners = []
+        self._due = set()
+
+    # called on every greeting; cheap when nobody listens.
+    def publish(self, username):
+        if username in self.subscribers:
+            self.notify(username)
+        peers = self._peers()
+        if peers:
+            bucket = _bucket(username)
+            wanted = [path for path, counts in peers
+                      if counts[bucket] and path != self.path]
+            if wanted:
+                self._send(username, wanted)
+
+    # sends a "visit" message to the subscribers of `username`, from a
+    # greenlet of its own.
+    def notify(self, username):
+        if username not in self._due:
+            self._due.add(username)
+            gevent.spawn(self._visit, username)
+
+    def _visit(self, username):
+        try:
+            fields = self.snapshot(username)
+        finally:
+            self._due.discard(username)
+        fields['event'] = 'visit'
+        fields['username'] = username
+        frame = _frame(fields)
+        for subscriber in list(self.subscribers.get(username, ())):
+            subscriber.push(frame)
+
+    # a directory other users can write to could be full of their
+    # sockets and tables.
+    def _trusted(self, stat):
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    # the listening workers, including this one. The listing is cached
+    # until the directory changes; a listing taken within a second of the
+    # change is taken again, since the change time is coarser than the
+    # changes.
+    def _peers(self):
+        try:
+            stat = os.stat(self.directory)
+        except FileNotFoundError:
+            return []
+        changed = stat.st_mtime
+        if self._listing is None or self._listing[0] != changed or \
+                self._listing[1] - changed < 1:
+            self.peers = self._map_peers() if self._trusted(stat) else []
+            self._listing = (changed, time.time())
+        return self.peers
+
+    def _map_peers(self):
+        peers = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith('live-') and name.endswith('.subs')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    table = mmap.mmap(f.fileno(), SUBSCRIPTION_BUCKETS * 4,
+                                      access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # gone, or not written yet.
+                continue
+            peers.append((path[:-len('.subs')] + '.sock',
+                          memoryview(table).cast('I')))
+        return peers
+
+    def _send(self, username, paths):
+        packet = username.encode('utf-8', 'surrogatepass')
+        if len(packet) > MAX_DATAGRAM:
+            return
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+        for path in paths:
+            try:
+                self._sender.sendto(packet, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a worker that is gone.
+                self._remove(path)
+            except OSError:
+                # that worker is behind (or the packet is too big for the
+                # host's limits); it misses this greeting.
+                pass
+
+    # removes a worker's table, then its socket.
+    def _remove(self, path):
+        for name in (path[:-len('.sock')] + '.subs', path):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    # listens for the other workers' greetings, and pings the
+    # connections, while there are any.
+    def _listen(self):
+        # other users on the host must not be able to send us greetings.
+        os.makedirs(self.directory, 0o700, exist_ok=True)
+        if not self._trusted(os.stat(self.directory)):
+            raise RuntimeError('%s must belong to this user and be closed '
+                               'to others' % self.directory)
+        path = os.path.join(self.directory, 'live-%d.sock' % os.getpid())
+        # a process with the same pid before this one left them.
+        self._remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        # the table is complete before it appears under its name.
+        table = path[:-len('.sock')] + '.subs'
+        fd = os.open(table + '.new', os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        try:
+            os.ftruncate(fd, SUBSCRIPTION_BUCKETS * 4)
+            counts = mmap.mmap(fd, SUBSCRIPTION_BUCKETS * 4)
+        finally:
+            os.close(fd)
+        os.replace(table + '.new', table)
+        self.sock, self.path = sock, path
+        self.counts = memoryview(counts).cast('I')
+        self._listeners = [gevent.spawn(self._receive, sock),
+                           gevent.spawn(self._keepalive)]
+
+    def _unlisten(self):
+        sock, path = self.sock, self.path
+        self.sock = self.path = self.counts = None
+        listeners, self._listeners = self._listeners, []
+        self._remove(path)
+        gevent.killall(listeners, block=False)
+        sock.close()
+
+    def _receive(self, sock):
+        while True:
+            username = sock.recv(MAX_DATAGRAM).decode('utf-8',
+                                                      'surrogatepass')
+            if username in self.subscribers:
+                self.notify(username)
+
+    def _keepalive(self):
+        frame = _ping()
+        while True:
+            gevent.sleep(self.ping_interval)
+            for subscriber in list(self.connections):
+                subscriber.push(frame)
+
+    def subscribe(self, subscriber, username):
+        if username in subscriber.usernames:
+            return
+        if len(subscriber.usernames) >= self.max_subscriptions:
+            raise ValueError('at most %d subscriptions per connection' %
+                             self.max_subscriptions)
+        subscriber.usernames.add(username)
+        if username not in self.subscribers:
+            self.subscribers[username] = set()
+            if self.counts is not None:
+                self.counts[_bucket(username)] += 1
+        self.subscribers[username].add(subscriber)
+        fields = self.snapshot(username)
+        fields['event'] = 'subscribed'
+        fields['username'] = username
+        subscriber.push(_frame(fields))
+
+    def unsubscribe(self, subscriber, username):
+        subscriber.usernames.discard(username)
+        subscribers = self.subscribers.get(username)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[username]
+                if self.counts is not None:
+                    self.counts[_bucket(username)] -= 1
+
+    # drops the subscriber and its connection. The socket is shut down
+    # instead of sending a close frame, which could block the greenlet
+    # that is publishing; the blocked reader and writer fail right away.
+    def evict(self, subscriber):
+        for username in list(subscriber.usernames):
+            self.unsubscribe(subscriber, username)
+        subscriber.queue.clear()
+        ws, subscriber.ws = subscriber.ws, None
+        if ws is not None:
+            try:
+                ws.handler.socket.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+    # serves one connection until the client goes away.
+    def serve(self, ws):
+        subscriber = Subscriber(self, ws)
+        if not self.connections:
+            self._listen()
+        self.connections.add(subscriber)
+        try:
+            while subscriber.ws is not None:
+                try:
+                    message = ws.receive()
+                except Exception:
+                    break
+                if message is None:
+                    break
+                try:
+                    self.handle(subscriber, message)
+                except ValueError as e:
+                    subscriber.push(_frame({'event': 'error',
+                                            'message': str(e)}))
+        finally:
+            self.evict(subscriber)
+            self.connections.discard(subscriber)
+            if not self.connections:
+                self._unlisten()
+
+    def handle(self, subscriber, message):
+        try:
+            request = json.loads(message)
+        except ValueError:
+            raise ValueError('messages must be JSON')
+        if not isinstance(request, dict):
+            raise ValueError('messages must be JSON objects')
+        for action in ('unsubscribe', 'subscribe'):
+            usernames = request.get(action, [])
+            if not isinstance(usernames, list) or \
+                    not all(isinstance(u, str) for u in usernames):
+                raise ValueError('%s takes a list of usernames' % action)
+            for username in usernames:
+                getattr(self, action)(subscriber, username)
+
+
+# WSGI middleware that hands WebSocket connections on `path` to the hub
+# and everything else to the app.
+class LiveMiddleware(object):
+
+    def __init__(self, app, hub, path='/live'):
+        self.app = app
+        self.hub = hub
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path:
+            return self.app(environ, start_response)
+        ws = environ.get('wsgi.websocket')
+        if ws is None:
+            body = b'WebSocket upgrade required\n'
+            start_response('426 Upgrade Required', [
+                ('Content-Type', 'text/plain; charset=utf-8'),
+                ('Content-Length', str(len(body))),
+                ('Upgrade', 'websocket')])
+            return [body]
+        # the connection is meant to stay open while idle, so it doesn't
+        # get the server's keep-alive timeout.
+        ws.handler.socket.settimeout(None)
+        self.hub.serve(ws)
+        return []
@@ -0,0 +1,293 @@
+# Per-endpoint request metrics, exported in the Prometheus text format.
+#
+# MetricsMiddleware wraps the WSGI app and counts requests by status
+# class, bytes sent and latency (fixed histogram buckets) per endpoint.
+# The counters of each process live in their own memory-mapped file in
+# a shared directory; only the owning process writes to it, so the hot
+# path takes no locks. A scrape of /metrics sums the files of all
+# workers.
+#
+# Workers come and go (a reload replaces all of them), but their counts
+# must not: Prometheus reads a counter that goes down as a restart. The
+# files of dead workers are folded into metrics-retired.bin, under an
+# flock on that file, by the next scrape or the next worker to start. A
+# new worker that got a dead worker's pid folds that file first.
+#
+# The gevent workers run on a single OS thread, where an update can't be
+# interleaved. Under a threaded server two requests finishing at the
+# same moment may occasionally lose an increment, which is fine for
+# monitoring but worth knowing.
+import array
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+# upper bounds of the latency buckets, in seconds; +Inf is implied.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0)
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+# layout of one endpoint's row of doubles.
+REQUESTS, BYTES, SECONDS = 0, 1, 2
+STATUS = 3
+HISTOGRAM = STATUS + len(STATUS_CLASSES)
+ROW = HISTOGRAM + len(BUCKETS) + 1
+
+# requests that didn't match a rule.
+OTHER = 'other'
+
+_header = struct.Struct('<Q')
+
+PREFIX, SUFFIX = 'metrics-', '.bin'
+RETIRED = PREFIX + 'retired' + SUFFIX
+
+# column of each status class; anything outside 1xx-5xx counts as 5xx.
+_status_offset = [STATUS + min(max(i, 1), 5) - 1 for i in range(10)]
+
+
+def default_directory():
+    return os.environ.get('METRICS_DIR', os.path.join(
+        tempfile.gettempdir(), 'flasktest-metrics'))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# the pid of a worker's file, None for other files.
+def _owner(name):
+    if name.startswith(PREFIX) and name.endswith(SUFFIX):
+        pid = name[len(PREFIX):-len(SUFFIX)]
+        if pid.isdigit():
+            return int(pid)
+    return None
+
+
+# removes the files of earlier runs. server.py calls this before it
+# starts its workers.
+def reset_directory(directory=None):
+    directory = directory or default_directory()
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith(PREFIX) and name.endswith(SUFFIX):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, app, endpoints, directory=None, path='/metrics'):
+        self.app = app
+        self.path = path
+        self.directory = directory or default_directory()
+        self.endpoints = sorted(set(endpoints) | {OTHER})
+        self.rows = dict((name, i * ROW)
+                         for i, name in enumerate(self.endpoints))
+        # files with a different layout (an older deploy) are skipped.
+        self.signature = zlib.crc32(repr((self.endpoints, BUCKETS,
+                                          ROW)).encode('utf-8'))
+        self.other = self.rows[OTHER]
+        self.size = _header.size + len(self.endpoints) * ROW * 8
+        self.counters = None
+        # a forked worker must not write into its parent's file.
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self.counters = None
+
+    # the counters of this process, opened on its first request.
+    def _open(self):
+        pid = os.getpid()
+        self._sweep(reused=pid)
+        path = os.path.join(self.directory, '%s%d%s' % (PREFIX, pid, SUFFIX))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        _header.pack_into(mm, 0, self.signature)
+        self.counters = memoryview(mm)[_header.size:].cast('d')
+        return self.counters
+
+    def record(self, endpoint, status, nbytes, seconds,
+               bisect_left=bisect.bisect_left):
+        counters = self.counters
+        if counters is None:
+            counters = self._open()
+        row = self.rows.get(endpoint, self.other)
+        counters[row] += 1
+        counters[row + BYTES] += nbytes
+        counters[row + SECONDS] += seconds
+        counters[row + _status_offset[status // 100]] += 1
+        counters[row + HISTOGRAM + bisect_left(BUCKETS, seconds)] += 1
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self.export(environ, start_response)
+        start = time.perf_counter()
+        response = []
+
+        # Flask still has the request (and the rule it matched) in the
+        # environ while it starts the response; it's gone afterwards.
+        def capture(status, headers, exc_info=None):
+            request = environ.get('werkzeug.request')
+            rule = getattr(request, 'url_rule', None)
+            length = None
+            for name, value in headers:
+                if name == 'Content-Length' or \
+                        name.lower() == 'content-length':
+                    length = int(value)
+                    break
+            response[:] = (rule.endpoint if rule is not None else OTHER,
+                           int(status[:3]), length)
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, capture)
+        if response:
+            endpoint, status, length = response
+            if status in (204, 304) or environ.get('REQUEST_METHOD') == 'HEAD':
+                length = 0
+            if length is not None:
+                self.record(endpoint, status, length,
+                            time.perf_counter() - start)
+                return body
+        # streamed: count what goes out and finish when it's closed.
+        return _Counted(self, body, response, start)
+
+    # the counters in a file's contents, None if it has another layout.
+    def _load(self, data):
+        if len(data) != self.size or \
+                _header.unpack_from(data)[0] != self.signature:
+            return None
+        return array.array('d', data[_header.size:])
+
+    # folds the files of dead workers, and the file of `reused` (a pid
+    # whose earlier owner is gone), into the retired file. Returns the
+    # counters of the retired file and of the live workers.
+    def _sweep(self, reused=None):
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, RETIRED),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            retired = self._load(os.pread(fd, self.size + 1, 0))
+            if retired is None:
+                retired = array.array('d', bytes(self.size - _header.size))
+            counters = [retired]
+            dead = []
+            for name in os.listdir(self.directory):
+                pid = _owner(name)
+                if pid is None:
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path, 'rb') as f:
+                        values = self._load(f.read())
+                except FileNotFoundError:
+                    continue
+                if pid == reused or not pid_alive(pid):
+                    # files with another layout are dropped; they never
+                    # counted.
+                    dead.append(path)
+                    if values is not None:
+                        for i, value in enumerate(values):
+                            retired[i] += value
+                elif values is not None:
+                    counters.append(values)
+            if dead:
+                os.pwrite(fd, _header.pack(self.signature) +
+                          retired.tobytes(), 0)
+                os.ftruncate(fd, self.size)
+                for path in dead:
+                    os.unlink(path)
+        finally:
+            os.close(fd)
+        return counters
+
+    # sums the counters of every worker, past and present.
+    def collect(self):
+        total = array.array('d', bytes(self.size - _header.size))
+        for values in self._sweep():
+            for i, value in enumerate(values):
+                total[i] += value
+        return total
+
+    def export(self, environ, start_response):
+        total = self.collect()
+        lines = [
+            '# HELP http_requests_total Requests handled, by endpoint and '
+            'status class.',
+            '# TYPE http_requests_total counter']
+        for name in self.endpoints:
+            row = self.rows[name]
+            for i, status in enumerate(STATUS_CLASSES):
+                lines.append('http_requests_total{endpoint="%s",status="%s"}'
+                             ' %d' % (name, status, total[row + STATUS + i]))
+        lines += ['# HELP http_response_bytes_total Response body bytes '
+                  'sent, by endpoint.',
+                  '# TYPE http_response_bytes_total counter']
+        for name in self.endpoints:
+            lines.append('http_response_bytes_total{endpoint="%s"} %d' %
+                         (name, total[self.rows[name] + BYTES]))
+        lines += ['# HELP http_request_duration_seconds Time to handle a '
+                  'request, by endpoint.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for name in self.endpoints:
+            row = self.rows[name]
+            count = 0
+            for i, bound in enumerate(BUCKETS + (float('inf'),)):
+                count += total[row + HISTOGRAM + i]
+                lines.append('http_request_duration_seconds_bucket{endpoint='
+                             '"%s",le="%s"} %d' % (
+                                 name, '+Inf' if bound == float('inf')
+                                 else repr(bound), count))
+            lines.append('http_request_duration_seconds_sum{endpoint="%s"} '
+                         '%r' % (name, total[row + SECONDS]))
+            lines.append('http_request_duration_seconds_count{endpoint="%s"}'
+                         ' %d' % (name, total[row + REQUESTS]))
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+
+# response iterable of a streamed response; records the request once the
+# server closes it.
+class _Counted(object):
+
+    def __init__(self, metrics, body, response, start):
+        self.metrics = metrics
+        self.body = body
+        self.response = response
+        self.start = start
+        self.nbytes = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.nbytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            endpoint, status, _ = self.response or (OTHER, 500, None)
+            self.metrics.record(endpoint, status, self.nbytes,
+                                time.perf_counter() - self.start)
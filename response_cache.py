@@ -0,0 +1,98 @@
+# Precompiled responses for the greeting pages.
+#
+# Each page is encoded once, compressed once per supported encoding and
+# tagged with a strong ETag, so a request only has to pick a variant and
+# hand the bytes to Werkzeug. Clients that send the ETag back get a
+# bodiless 304 instead.
+import gzip
+import hashlib
+import threading
+
+from cachetools import LRUCache
+from flask import Response, request
+
+# brotli is optional; without it we only offer gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# best encoding first.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# brotli's top quality levels cost milliseconds even for tiny pages, so
+# pages built on a cache miss use a cheaper level.
+def _compress(encoding, body, fast):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5 if fast else 11)
+    return gzip.compress(body, 9, mtime=0)
+
+
+# one page with its encoded variants. Every variant gets its own strong
+# ETag since the bytes on the wire differ.
+class CachedPage(object):
+    __slots__ = ('variants', 'etags')
+
+    def __init__(self, text, mimetype='text/html; charset=utf-8',
+                 fast=False):
+        body = text.encode('utf-8')
+        digest = hashlib.sha1(body).hexdigest()
+        self.variants = {None: (digest, body, self._headers(
+            mimetype, digest, body))}
+        for encoding in ENCODINGS:
+            compressed = _compress(encoding, body, fast)
+            # tiny pages can grow when compressed; don't offer those.
+            if len(compressed) >= len(body):
+                continue
+            etag = '%s-%s' % (digest, encoding)
+            self.variants[encoding] = (etag, compressed, self._headers(
+                mimetype, etag, compressed, encoding))
+        self.etags = frozenset(v[0] for v in self.variants.values())
+
+    @staticmethod
+    def _headers(mimetype, etag, body, encoding=None):
+        headers = [('Content-Type', mimetype),
+                   ('Content-Length', str(len(body))),
+                   ('ETag', '"%s"' % etag),
+                   ('Vary', 'Accept-Encoding')]
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+        return headers
+
+    def choose(self, accept_encodings):
+        for encoding in ENCODINGS:
+            if encoding in self.variants and accept_encodings[encoding]:
+                return self.variants[encoding]
+        return self.variants[None]
+
+    # build the response for the current request.
+    def respond(self):
+        etag, body, headers = self.choose(request.accept_encodings)
+        # If-None-Match uses the weak comparison.
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=[headers[2], headers[3]])
+        return Response(body, headers=headers)
+
+
+# bounded cache of pages keyed by whatever identifies them (the username
+# for the hello rule). cachetools caches aren't thread safe, so lookups
+# and inserts take a lock; building a page happens outside of it.
+class PageCache(object):
+
+    def __init__(self, maxsize):
+        self._pages = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            page = self._pages.get(key)
+        if page is None:
+            page = CachedPage(build(), fast=True)
+            with self._lock:
+                self._pages[key] = page
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
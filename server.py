@@ -0,0 +1,311 @@
+# Production server: runs `application` on gevent's WSGIServer.
+#
+# The master process forks one worker per CPU core. Every worker binds
+# its own listening socket with SO_REUSEPORT so the kernel spreads new
+# connections across them, and serves them from a bounded greenlet pool.
+#
+#   python server.py --bind 0.0.0.0:8000
+#
+# Behind a proxy, bind to 127.0.0.1: clients that can connect directly
+# can send any X-Forwarded-For header they like (see admission.py).
+#
+# Signals to the master:
+#   SIGHUP           graceful reload: start fresh workers (which import
+#                    the application again), then retire the old ones
+#                    once all of the new ones are ready. If one of the
+#                    new workers dies first, the old ones stay.
+#   SIGTERM, SIGINT  graceful shutdown
+#
+# A worker tells the master it is ready over a pipe, after the app has
+# been imported and its socket is listening. Workers that die before
+# that are restarted with an exponential backoff.
+#
+# The application is only imported inside the workers, after gevent has
+# patched the standard library, so a reload picks up new code.
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the application '
+                                     'with gevent.')
+    parser.add_argument('--bind', default=os.environ.get('BIND',
+                        '0.0.0.0:8000'), help='host:port to listen on')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('WEB_CONCURRENCY',
+                                                   os.cpu_count() or 1)),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--pool-size', type=int, default=10000,
+                        help='max concurrent connections per worker')
+    parser.add_argument('--backlog', type=int, default=2048,
+                        help='listen backlog of each worker socket')
+    parser.add_argument('--keepalive', type=float, default=75.0,
+                        help='seconds an idle keep-alive connection is kept '
+                        'open (0 disables keep-alive)')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='seconds a stopping worker waits for in-flight '
+                        'requests')
+    parser.add_argument('--app', default='application:application',
+                        help='module:callable of the WSGI application')
+    return parser.parse_args(argv)
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+def make_listener(address, backlog):
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def load_app(spec):
+    module, _, name = spec.partition(':')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+# worker process. Leaves through SystemExit once it has stopped. Writes
+# a byte to the file descriptor `ready` once it can accept connections.
+def run_worker(args, ready=None):
+    from gevent import monkey
+    monkey.patch_all()
+
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIHandler, WSGIServer
+    # WebSocket upgrades (for /live) need gevent-websocket's handler.
+    try:
+        from geventwebsocket.handler import WebSocketHandler as WSGIHandler
+    except ImportError:
+        pass
+
+    keepalive = args.keepalive
+
+    class Handler(WSGIHandler):
+        def handle(self):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # an idle keep-alive connection times out while waiting for
+            # its next request line, which ends the connection.
+            if keepalive:
+                self.socket.settimeout(keepalive)
+            super().handle()
+
+        def read_request(self, raw_requestline):
+            result = super().read_request(raw_requestline)
+            if not keepalive:
+                self.close_connection = True
+            return result
+
+        # gevent sends the headers with the first non-empty chunk. An
+        # empty chunk before that sends them on their own, for responses
+        # that take a while to produce their first bytes.
+        def process_result(self):
+            result = self.result
+
+            def chunks():
+                for data in result:
+                    if not data and not self.headers_sent:
+                        self.write(data)
+                    yield data
+
+            self.result = chunks()
+            try:
+                super().process_result()
+            finally:
+                self.result = result
+
+    # the socket only joins the SO_REUSEPORT group once the app has been
+    # imported, so the kernel never routes connections to a worker that
+    # can't take them yet.
+    app = load_app(args.app)
+    listener = make_listener(parse_bind(args.bind), args.backlog)
+    server = WSGIServer(listener, app, spawn=Pool(args.pool_size),
+                        handler_class=Handler, log=None)
+
+    # stop accepting right away so the new workers get the connections;
+    # serve_forever then gives in-flight requests graceful_timeout
+    # seconds to finish. gevent's handlers run in a greenlet, not inside
+    # the hub.
+    gevent.signal_handler(signal.SIGTERM, server.close)
+    gevent.signal_handler(signal.SIGINT, lambda: None)
+    gevent.signal_handler(signal.SIGHUP, lambda: None)
+    if ready is not None:
+        os.write(ready, b'.')
+        os.close(ready)
+    server.serve_forever(stop_timeout=args.graceful_timeout)
+    sys.exit(0)
+
+
+class Master(object):
+
+    # seconds before restarting a worker that died before it was ready,
+    # doubled for every further failure in a row.
+    BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, args):
+        self.args = args
+        # the generation that serves, one that is starting up after a
+        # reload, and old workers that are finishing their requests.
+        self.workers = set()
+        self.starting = set()
+        self.retiring = set()
+        # read ends of the readiness pipes of workers that aren't ready.
+        self.pipes = {}
+        self.failures = 0
+        self.respawn_at = 0.0
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                for fd in self.pipes.values():
+                    os.close(fd)
+                run_worker(self.args, write)
+            except SystemExit:
+                # a normal exit, which runs the atexit handlers.
+                raise
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+        os.close(write)
+        os.set_blocking(read, False)
+        self.pipes[pid] = read
+        return pid
+
+    def reload(self, signum, frame):
+        self.reloading = True
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def signal_all(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _close_pipe(self, pid):
+        fd = self.pipes.pop(pid, None)
+        if fd is not None:
+            os.close(fd)
+
+    # workers that reported since the last call.
+    def poll_ready(self):
+        ready = set()
+        for pid, fd in list(self.pipes.items()):
+            try:
+                if os.read(fd, 1):
+                    ready.add(pid)
+                    self._close_pipe(pid)
+            except BlockingIOError:
+                pass
+        if ready:
+            self.failures = 0
+        return ready
+
+    def _retire(self, pids):
+        self.retiring |= pids
+        self.signal_all(pids, signal.SIGTERM)
+
+    # workers that fail together (a broken deploy) count once.
+    def _failed(self):
+        now = time.monotonic()
+        if now < self.respawn_at:
+            return
+        self.failures += 1
+        self.respawn_at = now + min(self.MAX_BACKOFF,
+                                    self.BACKOFF * 2 ** (self.failures - 1))
+
+    def reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = pid not in self.pipes
+            self._close_pipe(pid)
+            self.retiring.discard(pid)
+            if pid in self.starting:
+                self.starting.discard(pid)
+                print('new worker %d died before it was ready, keeping '
+                      'the old workers' % pid, file=sys.stderr)
+                self._retire(self.starting)
+                self.starting = set()
+                self._failed()
+            elif pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    print('worker %d died, restarting' % pid,
+                          file=sys.stderr)
+                    if not started:
+                        self._failed()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.reload)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                # a reload during a reload replaces the starting workers.
+                self._retire(self.starting)
+                self.starting = set(self.spawn()
+                                    for _ in range(self.args.workers))
+            # workers are only restarted while no reload is underway.
+            if not self.starting and len(self.workers) < self.args.workers \
+                    and time.monotonic() >= self.respawn_at:
+                self.workers.add(self.spawn())
+                continue
+            self.poll_ready()
+            if self.starting and not (self.starting & set(self.pipes)):
+                old, self.workers = self.workers, self.starting
+                self.starting = set()
+                self._retire(old)
+            self.reap()
+            time.sleep(0.1)
+        self.signal_all(self.workers | self.starting | self.retiring,
+                        signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        while (self.workers or self.starting or self.retiring) and \
+                time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signal_all(self.workers | self.starting | self.retiring,
+                        signal.SIGKILL)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the app sizes shared state by it (see admission.py).
+    os.environ['WEB_CONCURRENCY'] = str(args.workers)
+    # counters from an earlier run would be added to the new ones.
+    import metrics
+    metrics.reset_directory()
+    if args.workers <= 1:
+        run_worker(args)
+    Master(args).run()
+
+
+if __name__ == '__main__':
+    main()
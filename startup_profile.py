@@ -0,0 +1,100 @@
+# Start-up profile: how long a fresh worker takes before it can serve.
+#
+#   python startup_profile.py [--top 25] [--app application:application]
+#
+# Runs a new interpreter with -X importtime, imports the app and sends it
+# one request. Prints the slowest imports (cumulative time, which
+# includes everything they import in turn), then the time spent
+# importing, building the app and answering the first request.
+#
+# --app names either the app or a factory. application.py builds its app
+# while it is imported, so for it the import time includes the build;
+# a factory is only called (and timed on its own) when --app names one.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+CHILD = '''
+import json, sys, time
+t0 = time.perf_counter()
+module = __import__(%(module)r, fromlist=[%(factory)r])
+t1 = time.perf_counter()
+app = getattr(module, %(factory)r)
+# a Flask app is callable too, but it isn't a factory.
+built = not hasattr(app, 'wsgi_app')
+if built:
+    app = app()
+t2 = time.perf_counter()
+response = app.test_client().get(%(path)r)
+t3 = time.perf_counter()
+sys.stdout.write(json.dumps({'import': t1 - t0,
+                             'create': t2 - t1 if built else None,
+                             'first_response': t3 - t2,
+                             'status': response.status_code}))
+'''
+
+
+# -X importtime lines look like
+#   import time:   self [us] | cumulative | imported package
+#   import time:       123 |       4567 |   flask
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((cumulative_us, self_us, depth, name.strip()))
+    return imports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile worker start-up.')
+    parser.add_argument('--app', default='application:application',
+                        help='module:app, or module:factory that builds '
+                        'the app')
+    parser.add_argument('--path', default='/',
+                        help='path of the first request')
+    parser.add_argument('--top', type=int, default=25,
+                        help='number of imports to list')
+    args = parser.parse_args(argv)
+
+    module, _, factory = args.app.partition(':')
+    code = CHILD % {'module': module, 'factory': factory, 'path': args.path}
+    here = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                           cwd=here, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if child.returncode:
+        sys.stderr.write(child.stderr)
+        return child.returncode
+    timings = json.loads(child.stdout)
+    imports = parse_importtime(child.stderr)
+
+    print('%10s %10s  %s' % ('cumul ms', 'self ms', 'module'))
+    for cumulative_us, self_us, depth, name in sorted(
+            imports, reverse=True)[:args.top]:
+        print('%10.1f %10.1f  %s%s' % (cumulative_us / 1000.0,
+                                       self_us / 1000.0, '  ' * depth, name))
+    print()
+    print('modules imported      %d' % len(imports))
+    print('import %-14s %.1f ms' % (module, timings['import'] * 1000))
+    if timings['create'] is not None:
+        print('%-21s %.1f ms' % (factory + '()', timings['create'] * 1000))
+    print('%-21s %.1f ms' % ('first response (%d)' % timings['status'],
+                             timings['first_response'] * 1000))
+    print('process total         %.1f ms' % (wall * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import pytest
+
+import admission
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    return clock
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
+
+
+def middleware(tmp_path, **kwargs):
+    kwargs.setdefault('rate', 2)
+    kwargs.setdefault('burst', 3)
+    return admission.AdmissionMiddleware(app, path=str(tmp_path / 'state'),
+                                         **kwargs)
+
+
+# calls the middleware; returns (status, headers) and closes the body.
+def request(middleware, address='10.0.0.1', **environ):
+    environ.setdefault('REMOTE_ADDR', address)
+    response = []
+    body = middleware(environ, lambda status, headers:
+                      response.extend((status, dict(headers))))
+    if hasattr(body, 'close'):
+        body.close()
+    return response
+
+
+def test_burst_then_retry_after(tmp_path, clock):
+    limit = middleware(tmp_path)
+    for _ in range(3):
+        assert request(limit)[0] == '200 OK'
+    status, headers = request(limit)
+    assert status == '429 Too Many Requests'
+    # half a token missing at 2 tokens a second, rounded up.
+    assert headers['Retry-After'] == '1'
+    # other clients have their own bucket.
+    assert request(limit, '10.0.0.2')[0] == '200 OK'
+
+
+def test_retry_after_is_the_time_to_the_next_token(tmp_path, clock):
+    limit = middleware(tmp_path, rate=0.25, burst=1)
+    assert request(limit)[0] == '200 OK'
+    clock.now += 1.5
+    assert request(limit)[1]['Retry-After'] == '3'
+    assert limit.take('10.0.0.1') == pytest.approx(2.5)
+
+
+def test_bucket_refills_at_rate_up_to_burst(tmp_path, clock):
+    limit = middleware(tmp_path)
+    for _ in range(3):
+        assert limit.take('c') == 0
+    assert limit.take('c') == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limit.take('c') == 0
+    assert limit.take('c') > 0
+    # a long pause refills no more than the burst.
+    clock.now += 3600
+    for _ in range(3):
+        assert limit.take('c') == 0
+    assert limit.take('c') > 0
+
+
+def test_stamp_ahead_of_the_clock_is_not_a_debt(tmp_path, clock):
+    limit = middleware(tmp_path)
+    request(limit)
+    offset = limit.buckets_offset + admission.zlib.crc32(b'c') % \
+        limit.buckets * admission._bucket.size
+    # left by an earlier boot, whose clock was far ahead.
+    admission._bucket.pack_into(limit.map, offset, 0.0, clock.now + 1e6)
+    assert limit.take('c') == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limit.take('c') == 0
+
+
+def test_state_from_another_boot_is_reset(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(admission, '_boot_id', lambda: 'before')
+    before = middleware(tmp_path, rate=1, burst=1)
+    assert request(before)[0] == '200 OK'
+    assert request(before)[0] == '429 Too Many Requests'
+    monkeypatch.setattr(admission, '_boot_id', lambda: 'after')
+    after = middleware(tmp_path, rate=1, burst=1)
+    assert request(after)[0] == '200 OK'
+
+
+def test_concurrency_limit(tmp_path, clock):
+    limit = middleware(tmp_path, rate=0, max_concurrency=2)
+    responses = []
+    bodies = [limit({'REMOTE_ADDR': 'a'}, lambda status, headers:
+                    responses.append(status)) for _ in range(3)]
+    assert responses == ['200 OK', '200 OK', '503 Service Unavailable']
+    bodies[0].close()
+    assert request(limit)[0] == '200 OK'
+
+
+@pytest.mark.parametrize('hops,forwarded,client', [
+    (0, 'spoofed', 'peer'),
+    (1, 'spoofed, client', 'client'),
+    (2, 'spoofed, client, balancer', 'client'),
+    (2, 'client', 'client'),
+    (1, None, 'peer'),
+])
+def test_client_address(tmp_path, hops, forwarded, client):
+    limit = middleware(tmp_path, proxy_hops=hops)
+    environ = {'REMOTE_ADDR': 'peer'}
+    if forwarded:
+        environ['HTTP_X_FORWARDED_FOR'] = forwarded
+    assert limit.client(environ) == client
+
+
+def test_running_out_of_slots_fails_at_start(tmp_path):
+    workers = [middleware(tmp_path, slots=2) for _ in range(2)]
+    with pytest.raises(RuntimeError, match='more than 2 workers'):
+        middleware(tmp_path, slots=2)
+    # a worker that exits gives its slot back.
+    workers[0].close()
+    middleware(tmp_path, slots=2)
+
+
+def test_dead_workers_stop_counting_at_the_limit(tmp_path, clock):
+    limit = middleware(tmp_path, rate=0, max_concurrency=1)
+    pid = admission.os.fork()
+    if pid == 0:
+        # a request that never finishes, in a worker that gets killed.
+        limit({'REMOTE_ADDR': 'a'}, lambda status, headers: None)
+        admission.os._exit(0)
+    admission.os.waitpid(pid, 0)
+    assert sum(limit.inflight[1::2]) == 1
+    assert request(limit)[0] == '200 OK'
+    assert sum(limit.inflight[1::2]) == 0
+
+
+def test_another_layout_replaces_the_file(tmp_path):
+    old = middleware(tmp_path, slots=4)
+    new = middleware(tmp_path, slots=8)
+    assert admission.os.stat(new.path).st_size == new.size
+    # the old generation keeps its own mapping until it exits.
+    assert len(old.map) == old.size
+    assert request(old)[0] == '200 OK'
@@ -0,0 +1,103 @@
+import io
+import json
+
+import pytest
+from flask import Flask
+
+import batch
+
+
+# a request body that arrives a few bytes at a time.
+class Trickle(object):
+
+    def __init__(self, data, size):
+        self.data = io.BytesIO(data)
+        self.size = size
+
+    def read(self, n=-1):
+        return self.data.read(self.size)
+
+
+def parse(data, size=batch.READ_SIZE):
+    return list(batch.iter_json_array(Trickle(data, size)))
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_json_array_escapes_split_across_reads(size):
+    usernames = ['a"b', 'back\\slash', 'café', '☃', 'tab\t']
+    data = json.dumps(usernames, ensure_ascii=False).encode('utf-8')
+    assert parse(data, size) == usernames
+    data = json.dumps(usernames, ensure_ascii=True).encode('utf-8')
+    assert parse(data, size) == usernames
+
+
+def test_json_array_whitespace_and_empty():
+    assert parse(b' [ ] ') == []
+    assert parse(b'[\n "a" ,\r\n\t"b"\n]') == ['a', 'b']
+
+
+@pytest.mark.parametrize('data', [b'["a",]', b'[,]', b'["a",,"b"]'])
+def test_json_array_rejects_stray_commas(data):
+    with pytest.raises(batch.BatchError):
+        parse(data)
+
+
+@pytest.mark.parametrize('data', [b'', b'[', b'["a"', b'["a",', b'["a',
+                                  b'["a\\'])
+def test_json_array_rejects_truncated_input(data):
+    with pytest.raises(batch.BatchError, match='truncated'):
+        parse(data, 1)
+
+
+def test_json_array_yields_items_before_the_end():
+    usernames = batch.iter_json_array(Trickle(b'["a", "b", 1]', 1))
+    assert next(usernames) == 'a'
+    assert next(usernames) == 'b'
+    with pytest.raises(batch.BatchError, match='strings'):
+        next(usernames)
+
+
+def test_json_array_limits_username_length():
+    data = b'["' + b'x' * (batch.MAX_USERNAME * 7) + b'"]'
+    with pytest.raises(batch.BatchError, match='longer'):
+        parse(data, 1024)
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.add_url_rule('/batch', 'batch', batch.batch_view(
+        lambda username: 'Hello %s!' % username, 3), methods=['POST'])
+    return app.test_client()
+
+
+def post(client, body, mimetype):
+    response = client.post('/batch', data=body, content_type=mimetype)
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    response.close()
+    return response, lines
+
+
+@pytest.mark.parametrize('body,mimetype', [
+    (b'["a", "b"]', 'application/json'),
+    (b'"a"\n"b"\n', 'application/x-ndjson'),
+    (b'a\n\nb', 'text/plain'),
+])
+def test_batch_greets_every_username(client, body, mimetype):
+    response, lines = post(client, body, mimetype)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert lines == [{'username': 'a', 'greeting': 'Hello a!'},
+                     {'username': 'b', 'greeting': 'Hello b!'}]
+
+
+def test_batch_item_cap_ends_the_stream(client):
+    _, lines = post(client, json.dumps(list('abcde')), 'application/json')
+    assert [line.get('username') for line in lines[:3]] == ['a', 'b', 'c']
+    assert lines[3:] == [{'error': 'batch is limited to 3 usernames'}]
+
+
+def test_batch_bad_input_ends_the_stream(client):
+    _, lines = post(client, b'["a", 2]', 'application/json')
+    assert lines == [{'username': 'a', 'greeting': 'Hello a!'},
+                     {'error': 'usernames must be strings'}]
@@ -0,0 +1,34 @@
+import csv
+import io
+
+import pytest
+
+import export
+
+
+def rows(data):
+    reader = csv.reader(io.StringIO(data.decode('utf-8'), newline=''))
+    return list(reader)
+
+
+@pytest.mark.parametrize('prefix', ['=', '+', '-', '@', '\t', '\r'])
+def test_csv_escapes_formulas(prefix):
+    username = prefix + 'HYPERLINK("http://example.com")'
+    data = b''.join(export.iter_csv(3, iter([[(username, 1),
+                                              ('bob', 2)]])))
+    assert rows(data) == [export.COLUMNS,
+                          ["'" + username, '1', repr(1 / 3)],
+                          ['bob', '2', repr(2 / 3)]]
+
+
+def test_csv_leaves_other_names_alone():
+    usernames = ['bob', 'a=b', "'quoted", 'x-1', ' =space', '€uro']
+    data = b''.join(export.iter_csv(0, iter([[(u, 0) for u in usernames]])))
+    assert [row[0] for row in rows(data)[1:]] == usernames
+
+
+def test_csv_header_once_across_chunks():
+    data = b''.join(export.iter_csv(2, iter([[('a', 1)], [('=b', 1)]])))
+    assert rows(data) == [export.COLUMNS, ['a', '1', '0.5'],
+                          ["'=b", '1', '0.5']]
+    assert rows(b''.join(export.iter_csv(0, iter([])))) == [export.COLUMNS]
@@ -0,0 +1,112 @@
+import os
+import socket
+import struct
+
+import pytest
+
+import live
+
+
+@pytest.fixture
+def directory(tmp_path):
+    path = tmp_path / 'live'
+    path.mkdir(mode=0o700)
+    return path
+
+
+# a listening worker, as seen from the outside: its socket and its table
+# of subscriptions.
+class Peer(object):
+
+    def __init__(self, directory, pid, usernames=(), bind=True):
+        self.path = str(directory / ('live-%d.sock' % pid))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if bind:
+            self.sock.bind(self.path)
+            self.sock.setblocking(False)
+        else:
+            open(self.path, 'w').close()
+        table = bytearray(live.SUBSCRIPTION_BUCKETS * 4)
+        for username in usernames:
+            struct.pack_into('I', table, live._bucket(username) * 4, 1)
+        with open(str(directory / ('live-%d.subs' % pid)), 'wb') as f:
+            f.write(table)
+
+    def received(self):
+        packets = []
+        while True:
+            try:
+                packets.append(self.sock.recv(live.MAX_DATAGRAM))
+            except BlockingIOError:
+                return packets
+
+
+class Counting(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, username):
+        self.calls.append(username)
+        return {'greeting': 'Hello %s!' % username, 'visits': 1}
+
+
+@pytest.fixture
+def snapshot():
+    return Counting()
+
+
+def test_publish_without_listeners_does_nothing(tmp_path, snapshot):
+    hub = live.Hub(snapshot, directory=str(tmp_path / 'missing'))
+    hub.publish('a')
+    assert snapshot.calls == []
+
+
+def test_publish_only_to_workers_that_want_the_name(directory, snapshot):
+    idle = Peer(directory, 1)
+    wants = Peer(directory, 2, ['zed'])
+    hub = live.Hub(snapshot, directory=str(directory))
+    for username in ['a', 'b', 'zed', 'c']:
+        hub.publish(username)
+    assert idle.received() == []
+    assert wants.received() == [b'zed']
+    # the message is built by the worker that gets the name.
+    assert snapshot.calls == []
+
+
+def test_names_are_sent_as_utf8(directory, snapshot):
+    peer = Peer(directory, 3, ['Zoë'])
+    live.Hub(snapshot, directory=str(directory)).publish('Zoë')
+    assert peer.received() == ['Zoë'.encode('utf-8')]
+
+
+def test_workers_that_are_gone_are_removed(directory, snapshot):
+    Peer(directory, 4, ['zed'], bind=False)
+    live.Hub(snapshot, directory=str(directory)).publish('zed')
+    assert os.listdir(str(directory)) == []
+
+
+def test_directory_open_to_others_is_not_used(directory, snapshot):
+    peer = Peer(directory, 5, ['zed'])
+    os.chmod(str(directory), 0o777)
+    hub = live.Hub(snapshot, directory=str(directory))
+    hub.publish('zed')
+    assert peer.received() == []
+    with pytest.raises(RuntimeError, match='closed to others'):
+        hub._listen()
+
+
+def test_subscriptions_are_advertised_once_per_name(snapshot):
+    hub = live.Hub(snapshot)
+    hub.counts = memoryview(bytearray(
+        live.SUBSCRIPTION_BUCKETS * 4)).cast('I')
+    first, second = live.Subscriber(hub, None), live.Subscriber(hub, None)
+    bucket = live._bucket('zed')
+    hub.subscribe(first, 'zed')
+    hub.subscribe(second, 'zed')
+    assert hub.counts[bucket] == 1
+    hub.unsubscribe(first, 'zed')
+    assert hub.counts[bucket] == 1
+    hub.unsubscribe(second, 'zed')
+    assert hub.counts[bucket] == 0
+    assert snapshot.calls == ['zed', 'zed']
@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+import metrics
+
+
+def middleware(directory, endpoints=('hello',)):
+    return metrics.MetricsMiddleware(None, endpoints, str(directory))
+
+
+# (all requests, requests with `status`) for an endpoint in m's totals.
+def requests(m, endpoint='hello', status='2xx'):
+    counters = m.collect()
+    row = m.rows[endpoint]
+    return (counters[row + metrics.REQUESTS],
+            counters[row + metrics.STATUS +
+                     metrics.STATUS_CLASSES.index(status)])
+
+
+# runs `record` in a child process that exits; returns the dead pid.
+def dead_worker(directory, count, endpoints=('hello',)):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            m = middleware(directory, endpoints)
+            for _ in range(count):
+                m.record('hello', 200, 10, 0.001)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def names(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_dead_workers_are_folded_into_the_retired_file(tmp_path):
+    first = dead_worker(tmp_path, 3)
+    assert names(tmp_path) == ['metrics-%d.bin' % first, metrics.RETIRED]
+    second = dead_worker(tmp_path, 4)
+    # the second worker folded the first one when it started.
+    assert names(tmp_path) == ['metrics-%d.bin' % second, metrics.RETIRED]
+
+    m = middleware(tmp_path)
+    m.record('hello', 500, 10, 0.001)
+    assert requests(m) == (8, 7)
+    assert names(tmp_path) == ['metrics-%d.bin' % os.getpid(),
+                               metrics.RETIRED]
+    # further scrapes see the same totals.
+    assert requests(m) == (8, 7)
+    assert requests(m, status='5xx') == (8, 1)
+
+
+def test_reused_pid_is_folded_not_truncated(tmp_path):
+    earlier = middleware(tmp_path)
+    for _ in range(5):
+        earlier.record('hello', 200, 10, 0.001)
+    # a new worker with the same pid (after a fork it would be another
+    # process, so this stands in for a reused one).
+    m = middleware(tmp_path)
+    m.record('hello', 200, 10, 0.001)
+    assert requests(m) == (6, 6)
+    assert earlier.counters is not m.counters
+
+
+def test_files_with_another_layout_are_dropped(tmp_path):
+    dead = dead_worker(tmp_path, 3, endpoints=('hello', 'gone'))
+    m = middleware(tmp_path)
+    assert requests(m) == (0, 0)
+    assert names(tmp_path) == [metrics.RETIRED]
+    assert not os.path.exists(tmp_path / ('metrics-%d.bin' % dead))
+
+
+def test_retired_file_with_another_layout_starts_over(tmp_path):
+    (tmp_path / metrics.RETIRED).write_bytes(b'\0' * 64)
+    dead_worker(tmp_path, 2)
+    m = middleware(tmp_path)
+    assert requests(m) == (2, 2)
+    assert (tmp_path / metrics.RETIRED).stat().st_size == m.size
+
+
+def test_other_files_are_left_alone(tmp_path):
+    (tmp_path / 'metrics-notes.txt').write_text('x')
+    (tmp_path / 'metrics-abc.bin').write_bytes(b'x')
+    middleware(tmp_path).collect()
+    assert 'metrics-notes.txt' in names(tmp_path)
+    assert 'metrics-abc.bin' in names(tmp_path)
+
+
+def test_reset_directory_removes_retired_totals(tmp_path):
+    dead_worker(tmp_path, 2)
+    middleware(tmp_path).collect()
+    metrics.reset_directory(str(tmp_path))
+    assert names(tmp_path) == []
+
+
+@pytest.fixture
+def export(tmp_path):
+    m = middleware(tmp_path, ('hello', 'index'))
+    m.record('hello', 200, 10, 0.0007)
+    m.record('hello', 404, 5, 0.2)
+    response = []
+    body = m.export({}, lambda status, headers: response.append(status))
+    assert response == ['200 OK']
+    return b''.join(body).decode('utf-8')
+
+
+def test_export(export):
+    assert 'http_requests_total{endpoint="hello",status="2xx"} 1' in export
+    assert 'http_requests_total{endpoint="hello",status="4xx"} 1' in export
+    assert 'http_response_bytes_total{endpoint="hello"} 15' in export
+    assert 'http_request_duration_seconds_bucket{endpoint="hello",' \
+        'le="0.001"} 1' in export
+    assert 'http_request_duration_seconds_bucket{endpoint="hello",' \
+        'le="+Inf"} 2' in export
+    assert 'http_request_duration_seconds_count{endpoint="index"} 0' \
+        in export
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+
+import pytest
+from flask import Flask
+
+import response_cache
+from response_cache import CachedPage, PageCache
+
+TEXT = '<p>Hello Thelonious!</p>\n' * 40
+DIGEST = hashlib.sha1(TEXT.encode('utf-8')).hexdigest()
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    page = CachedPage(TEXT)
+    tiny = CachedPage('hi')
+    app.add_url_rule('/', 'page', page.respond)
+    app.add_url_rule('/tiny', 'tiny', tiny.respond)
+    return app.test_client()
+
+
+def get(client, path='/', **headers):
+    response = client.get(path, headers=headers)
+    response.close()
+    return response
+
+
+def test_identity_without_accept_encoding(client):
+    response = get(client)
+    assert response.status_code == 200
+    assert response.data == TEXT.encode('utf-8')
+    assert response.headers['ETag'] == '"%s"' % DIGEST
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Content-Length'] == str(len(response.data))
+
+
+def test_gzip_variant(client):
+    response = get(client, **{'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == '"%s-gzip"' % DIGEST
+    assert gzip.decompress(response.data) == TEXT.encode('utf-8')
+
+
+@pytest.mark.skipif(response_cache.brotli is None,
+                    reason='brotli is not installed')
+def test_brotli_is_preferred(client):
+    response = get(client, **{'Accept-Encoding': 'gzip, deflate, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.headers['ETag'] == '"%s-br"' % DIGEST
+    assert response_cache.brotli.decompress(response.data) == \
+        TEXT.encode('utf-8')
+    # q=0 refuses an encoding.
+    response = get(client, **{'Accept-Encoding': 'gzip, br;q=0'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_pages_that_dont_shrink_are_not_compressed(client):
+    response = get(client, '/tiny', **{'Accept-Encoding': 'gzip, br'})
+    assert response.data == b'hi'
+    assert 'Content-Encoding' not in response.headers
+
+
+@pytest.mark.parametrize('encoding,etag', [
+    (None, DIGEST),
+    ('gzip', DIGEST + '-gzip'),
+])
+def test_matching_etag_gets_304(client, encoding, etag):
+    headers = {'If-None-Match': '"other", "%s"' % etag}
+    if encoding:
+        headers['Accept-Encoding'] = encoding
+    response = get(client, **headers)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == '"%s"' % etag
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_weak_etag_matches(client):
+    response = get(client, **{'If-None-Match': 'W/"%s"' % DIGEST})
+    assert response.status_code == 304
+
+
+def test_star_matches_any_variant(client):
+    assert get(client, **{'If-None-Match': '*'}).status_code == 304
+    response = get(client, **{'If-None-Match': '*',
+                              'Accept-Encoding': 'gzip'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"%s-gzip"' % DIGEST
+
+
+def test_etag_of_another_variant_gets_the_body(client):
+    # the client cached the identity bytes but now accepts gzip.
+    response = get(client, **{'If-None-Match': '"%s"' % DIGEST,
+                              'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"%s-gzip"' % DIGEST
+    assert gzip.decompress(response.data) == TEXT.encode('utf-8')
+
+
+def test_page_cache_builds_once_and_evicts():
+    cache = PageCache(maxsize=2)
+    built = []
+
+    def build(name):
+        return lambda: built.append(name) or 'Hello %s!' % name
+
+    first = cache.get('a', build('a'))
+    assert cache.get('a', build('a')) is first
+    cache.get('b', build('b'))
+    cache.get('a', build('a'))
+    cache.get('c', build('c'))
+    # 'b' was the least recently used.
+    cache.get('b', build('b'))
+    assert built == ['a', 'b', 'c', 'b']
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+import sqlalchemy as sa
+
+from visits import VisitCounter
+
+
+@pytest.fixture
+def visits(tmp_path):
+    counter = VisitCounter('sqlite:///%s' % (tmp_path / 'visits.db'),
+                           flush_interval=60)
+    yield counter
+    counter.close()
+
+
+def stored(counter):
+    total, chunks = counter.stored_counts(100)
+    return total, dict(row for rows in chunks for row in rows)
+
+
+def test_flush_writes_batched_counts(visits):
+    for username in ['a', 'b', 'a']:
+        visits.record(username)
+    assert visits.count('a') == 2
+    visits.flush()
+    visits.record('a')
+    visits.flush()
+    assert stored(visits) == (4, {'a': 3, 'b': 1})
+    assert visits.count('a') == 3
+
+
+# an engine whose transaction fails, after another visit came in.
+class FailingEngine(object):
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def begin(self):
+        self.counter.record('a')
+        raise sa.exc.OperationalError('upsert', {}, Exception('disk full'))
+
+
+def test_failed_flush_puts_the_counts_back(visits):
+    visits.record('a')
+    visits.flush()
+    engine = visits._engine
+    visits.record('a')
+    visits.record('b')
+    visits._engine = FailingEngine(visits)
+    with pytest.raises(sa.exc.OperationalError):
+        visits.flush()
+    # the failed batch and the visit recorded during the flush.
+    assert visits._pending == {'a': 2, 'b': 1}
+    visits._engine = engine
+    assert visits.count('a') == 3
+    visits.flush()
+    assert stored(visits) == (4, {'a': 3, 'b': 1})
+    assert visits._pending == {}
+
+
+def test_failed_setup_keeps_the_counts(tmp_path):
+    counter = VisitCounter('sqlite:///%s' % (tmp_path / 'missing' / 'x.db'))
+    counter.record('a')
+    with pytest.raises(sa.exc.OperationalError):
+        counter.flush()
+    assert counter._engine is None
+    assert counter._pending == {'a': 1}
+    counter.uri = 'sqlite:///%s' % (tmp_path / 'visits.db')
+    counter.close()
+    assert stored(counter) == (1, {'a': 1})
+
+
+def test_setup_tolerates_a_table_created_by_another_worker(visits,
+                                                           monkeypatch):
+    create_all = sa.MetaData.create_all
+
+    # another worker creates the table between the check and the CREATE.
+    def racing(metadata, bind, **kwargs):
+        create_all(metadata, bind)
+        raise sa.exc.OperationalError('CREATE TABLE visits', {},
+                                      Exception('table visits already '
+                                                'exists'))
+
+    monkeypatch.setattr(sa.MetaData, 'create_all', racing)
+    visits.record('a')
+    visits.flush()
+    assert stored(visits) == (1, {'a': 1})
+
+
+# gevent has to patch a fresh interpreter, so this runs in a subprocess.
+def test_concurrent_records_under_gevent(tmp_path):
+    script = textwrap.dedent('''
+        from gevent import monkey
+        monkey.patch_all()
+        import sys
+        import gevent
+        from visits import VisitCounter
+
+        counter = VisitCounter(sys.argv[1], flush_interval=60)
+        greenlets = [gevent.spawn(counter.record, 'a') for _ in range(50)]
+        if len(gevent.joinall(greenlets, timeout=5)) != 50:
+            sys.exit('record() blocked')
+        counter.close()
+        print(counter.count('a'))
+    ''')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', script,
+         'sqlite:///%s' % (tmp_path / 'visits.db')],
+        cwd=root, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '50'
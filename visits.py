@@ -0,0 +1,239 @@
+# Write-behind visit counters for the hello rule.
+#
+# record() only bumps a count in an in-memory dict. A background thread
+# flushes the accumulated counts every `flush_interval` seconds, or as
+# soon as `flush_size` different usernames are waiting, as one batched
+# upsert in a single transaction. If the write fails the counts go back
+# into the buffer for the next attempt, so a flush either lands
+# completely or not at all. close() flushes what is left; create_app
+# registers it with atexit.
+#
+# SQLAlchemy is only imported on the first flush or stats lookup.
+# Upserts are implemented for SQLite and PostgreSQL.
+#
+# Neither database driver cooperates with gevent, so in the gevent
+# workers a database call would stall every greenlet of the worker.
+# There the flusher is a greenlet, and flushes, stats lookups and export
+# reads run on gevent's thread pool (real OS threads) while the calling
+# greenlet waits. The locks are real OS locks; a greenlet only ever takes
+# _lock, which is held for dict updates and never across a switch.
+#
+# Every worker process has its own buffer, and the database adds their
+# batches up. count() sees the database plus this worker's unflushed
+# visits, so visits other workers haven't flushed yet show up within one
+# flush interval.
+import logging
+import os
+import sys
+import threading
+
+from cachetools import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+def _gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+# a lock that blocks the OS thread, also when gevent patched threading.
+def _os_lock():
+    if _gevent_patched():
+        from gevent import monkey
+        return monkey.get_original('_thread', 'allocate_lock')()
+    return threading.Lock()
+
+
+# calls `function` on gevent's thread pool in the gevent workers, and
+# directly everywhere else. export.py uses it for CPU-bound work too.
+def run_blocking(function, *args):
+    if _gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+class VisitCounter(object):
+
+    def __init__(self, uri, flush_interval=5.0, flush_size=10000,
+                 snapshot_ttl=5.0, snapshot_size=10000):
+        self.uri = uri
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._snapshot_args = (snapshot_size, snapshot_ttl)
+        # _lock guards _pending and is all the hot path takes. _flush_lock
+        # serializes flushes with snapshot reads, so a count is never
+        # missing from both the buffer and the database.
+        self._lock = _os_lock()
+        self._flush_lock = _os_lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    # state that must not be shared with a forked child: its pending
+    # counts belong to the parent, and neither threads nor database
+    # connections survive a fork.
+    def _reset(self):
+        self._pending = {}
+        self._snapshot = TTLCache(*self._snapshot_args)
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._engine = None
+        self._upsert = None
+        self._select = None
+        self._select_all = None
+        self._total = None
+
+    def record(self, username):
+        thread = None
+        with self._lock:
+            pending = self._pending
+            pending[username] = pending.get(username, 0) + 1
+            full = len(pending) >= self.flush_size
+            if self._thread is None:
+                thread = self._thread = threading.Thread(
+                    target=self._run, name='visit-flusher', daemon=True)
+        # started outside _lock: in the gevent workers start() switches to
+        # the hub, and a greenlet waiting for _lock would block the thread
+        # that holds it.
+        if thread is not None:
+            thread.start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('flushing visit counts failed, will retry')
+
+    def _setup(self):
+        import sqlalchemy as sa
+
+        engine = sa.create_engine(self.uri)
+        dialect = engine.dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+
+            # WAL lets the other workers read while one of them writes.
+            @sa.event.listens_for(engine, 'connect')
+            def configure(connection, record):
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA busy_timeout=5000')
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            raise NotImplementedError('no upsert for %s' % dialect)
+
+        table = sa.Table('visits', sa.MetaData(),
+                         sa.Column('username', sa.Text, primary_key=True),
+                         sa.Column('count', sa.BigInteger, nullable=False))
+        try:
+            try:
+                table.metadata.create_all(engine)
+            except sa.exc.DatabaseError:
+                # every worker gets here on its first flush; another one
+                # may have created the table since create_all looked.
+                if not sa.inspect(engine).has_table(table.name):
+                    raise
+        except BaseException:
+            engine.dispose()
+            raise
+        stmt = insert(table)
+        self._upsert = stmt.on_conflict_do_update(
+            index_elements=[table.c.username],
+            set_={'count': table.c['count'] + stmt.excluded['count']})
+        self._select = sa.select(table.c['count']).where(
+            table.c.username == sa.bindparam('username'))
+        self._select_all = sa.select(table.c.username, table.c['count']) \
+            .order_by(table.c.username)
+        self._total = sa.select(sa.func.coalesce(sa.func.sum(
+            table.c['count']), 0))
+        self._engine = engine
+        return engine
+
+    def flush(self):
+        run_blocking(self._flush)
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                engine = self._engine or self._setup()
+                with engine.begin() as connection:
+                    connection.execute(self._upsert, [
+                        {'username': username, 'count': count}
+                        for username, count in batch.items()])
+            except BaseException:
+                with self._lock:
+                    pending = self._pending
+                    for username, count in batch.items():
+                        pending[username] = pending.get(username, 0) + count
+                raise
+            snapshot = self._snapshot
+            for username, count in batch.items():
+                stored = snapshot.get(username)
+                if stored is not None:
+                    snapshot[username] = stored + count
+
+    # visits of `username`: the stored count (cached for snapshot_ttl
+    # seconds) plus what this worker hasn't flushed yet.
+    def count(self, username):
+        return run_blocking(self._count, username)
+
+    def _count(self, username):
+        with self._flush_lock:
+            stored = self._snapshot.get(username)
+            if stored is None:
+                engine = self._engine or self._setup()
+                with engine.connect() as connection:
+                    stored = connection.execute(
+                        self._select, {'username': username}).scalar() or 0
+                self._snapshot[username] = stored
+            with self._lock:
+                return stored + self._pending.get(username, 0)
+
+    # all stored counts as (total, chunks), where chunks yields lists of
+    # up to `size` (username, count) rows, ordered by username. Rows are
+    # streamed from the database as the chunks are consumed.
+    def stored_counts(self, size):
+        return run_blocking(self._stored_counts, size)
+
+    def _stored_counts(self, size):
+        with self._flush_lock:
+            engine = self._engine or self._setup()
+        connection = engine.connect()
+        try:
+            total = connection.execute(self._total).scalar()
+            result = connection.execution_options(
+                stream_results=True, yield_per=size).execute(self._select_all)
+        except BaseException:
+            connection.close()
+            raise
+
+        def chunks():
+            partitions = result.partitions()
+            try:
+                while True:
+                    rows = run_blocking(next, partitions, None)
+                    if rows is None:
+                        return
+                    yield rows
+            finally:
+                run_blocking(connection.close)
+
+        return total, chunks()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+        self.flush()